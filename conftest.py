@@ -0,0 +1,8 @@
+# `pytest.ini` collects doctests from the package modules, so the modules that
+# need optional dependencies are skipped when those aren't installed
+collect_ignore = []
+
+try:
+    import jax  # noqa: F401
+except ImportError:  # pragma: no cover
+    collect_ignore.append("pymc3_hmm/_ffbs_jax.py")
@@ -0,0 +1,45 @@
+"""A JAX implementation of the FFBS forward pass.
+
+This is used by `pymc3_hmm.step_methods.ffbs_step` when ``backend="jax"``;
+it isn't meant to be used directly.
+"""
+import jax
+import jax.numpy as jnp
+from jax.scipy.special import logsumexp
+
+
+def _forward_step(log_alpha_nm1, inputs):
+    log_Gamma_n, log_lik_n = inputs
+    log_alpha_n = logsumexp(log_alpha_nm1[:, None] + log_Gamma_n, axis=0) + log_lik_n
+    log_alpha_n = log_alpha_n - logsumexp(log_alpha_n)
+    return log_alpha_n, log_alpha_n
+
+
+@jax.jit
+def _forward_jax(gamma_0, Gammas, log_lik):
+    """Compute the normalized log-scale forward probabilities.
+
+    Parameters
+    ----------
+    gamma_0
+        The initial state probabilities.
+    Gammas
+        An array of shape ``(N, M, M)`` or ``(1, M, M)`` containing the
+        transition probability matrices.
+    log_lik
+        An array of shape ``(M, N)`` containing the log-likelihood values for
+        each state at each point in the sequence.
+
+    Returns
+    -------
+    An array of shape ``(M, N)`` containing the log-scale forward
+    probabilities.
+
+    """
+    N = log_lik.shape[-1]
+    log_Gammas = jnp.broadcast_to(jnp.log(Gammas), (N,) + Gammas.shape[-2:])
+    log_gamma_0 = jnp.log(gamma_0) - jnp.log(jnp.sum(gamma_0))
+
+    _, log_alphas = jax.lax.scan(_forward_step, log_gamma_0, (log_Gammas, log_lik.T))
+
+    return log_alphas.T
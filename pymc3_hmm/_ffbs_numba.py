@@ -0,0 +1,307 @@
+"""Compiled kernels for forward-filtering backward-sampling (FFBS).
+
+These functions are called by `pymc3_hmm.step_methods.ffbs_step` when its
+arguments are contiguous floating-point arrays, and by
+`pymc3_hmm.step_methods.FFBSStep`; they aren't meant to be used directly.
+They don't check their array bounds, so the shapes of their arguments must be
+validated beforehand (e.g. as `pymc3_hmm.step_methods.ffbs_step` does).
+"""
+import math
+
+import numpy as np
+from numba import njit
+
+# We can't use `fastmath=True`, because it implies that there are no `inf`s
+# and log-likelihoods of `-inf` are used to specify impossible states.
+_fastmath_flags = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+# N.B. `coverage` can't trace the compiled functions, so they're all marked with
+# `pragma: no cover`
+
+
+@njit(cache=True, fastmath=_fastmath_flags, error_model="numpy")  # pragma: no cover
+def _log_matrix(A, log_A):
+    """Compute the element-wise log of a matrix in-place."""
+    for i in range(A.shape[0]):
+        for j in range(A.shape[1]):
+            log_A[i, j] = np.log(A[i, j])
+
+
+@njit(cache=True, fastmath=_fastmath_flags, error_model="numpy")  # pragma: no cover
+def _logsumexp_forward_step(log_P_t, alpha_prev, log_lik_t, alpha_out):
+    r"""Compute one step of the log-scale forward recursion in-place.
+
+    This computes
+
+    .. math::
+
+        \log \alpha_t(k) = \log p(y_t \mid S_t = k)
+            + \log \sum_i \exp\left(
+                \log P_{ik} + \log \alpha_{t-1}(i)
+            \right)
+
+    using a fused max-exp-sum-log pass for each state, then normalizes the
+    result so that :math:`\sum_k \alpha_t(k) = 1`.
+
+    """
+    M = alpha_prev.shape[0]
+
+    for k in range(M):
+        m = -np.inf
+        for i in range(M):
+            m = max(m, log_P_t[i, k] + alpha_prev[i])
+
+        if m == -np.inf:
+            alpha_out[k] = -np.inf
+            continue
+
+        s = 0.0
+        for i in range(M):
+            s += np.exp(log_P_t[i, k] + alpha_prev[i] - m)
+
+        alpha_out[k] = log_lik_t[k] + m + np.log(s)
+
+    m = -np.inf
+    for k in range(M):
+        m = max(m, alpha_out[k])
+
+    s = 0.0
+    for k in range(M):
+        s += np.exp(alpha_out[k] - m)
+
+    log_norm = m + np.log(s)
+    for k in range(M):
+        alpha_out[k] -= log_norm
+
+
+@njit(cache=True, fastmath=_fastmath_flags, error_model="numpy")  # pragma: no cover
+def _forward(gamma_0, Gammas, log_lik, log_alphas):
+    """Compute the normalized log-scale forward probabilities in-place.
+
+    Parameters
+    ----------
+    gamma_0
+        The initial state probabilities.
+    Gammas
+        An array of shape ``(N, M, M)`` or ``(1, M, M)`` containing the
+        transition probability matrices.
+    log_lik
+        An array of shape ``(M, N)`` containing the log-likelihood values for
+        each state at each point in the sequence.
+    log_alphas
+        An array of shape ``(M, N)`` in which the log-scale forward
+        probabilities are stored.  Its rows are stored contiguously, so each
+        state's sequence of forward probabilities is a contiguous array.  It
+        can be a ``float32`` array, in which case the recursion is still
+        computed in ``float64`` and only the stored values are narrowed.
+
+    """
+    M, N = log_lik.shape
+    time_varying = Gammas.shape[0] > 1
+
+    log_Gamma = np.empty((M, M))
+    _log_matrix(Gammas[0], log_Gamma)
+
+    log_alpha_nm1 = np.log(gamma_0 / np.sum(gamma_0)).astype(np.float64)
+    log_alpha_n = np.empty(M)
+
+    for n in range(N):
+        if time_varying:
+            _log_matrix(Gammas[n], log_Gamma)
+
+        _logsumexp_forward_step(log_Gamma, log_alpha_nm1, log_lik[:, n], log_alpha_n)
+
+        for k in range(M):
+            log_alphas[k, n] = log_alpha_n[k]
+
+        log_alpha_nm1, log_alpha_n = log_alpha_n, log_alpha_nm1
+
+
+@njit(cache=True, fastmath=_fastmath_flags, error_model="numpy")  # pragma: no cover
+def _sample_categorical(p, u):
+    """Sample a state from unnormalized probabilities `p` using a uniform `u`.
+
+    This is an inverse-CDF pick: the first state whose cumulative probability
+    is at least `u` is returned.
+    """
+    M = p.shape[0]
+
+    if M == 2:
+        # A single comparison suffices for two states
+        return np.intp(u * (p[0] + p[1]) > p[0])
+
+    p_sum = 0.0
+    for i in range(M):
+        p_sum += p[i]
+
+    u_scaled = u * p_sum
+    p_cumsum = 0.0
+    for i in range(M - 1):
+        p_cumsum += p[i]
+        if u_scaled <= p_cumsum:
+            return i
+
+    return M - 1
+
+
+@njit(cache=True, fastmath=_fastmath_flags, error_model="numpy")  # pragma: no cover
+def _sample_log_categorical(log_p, p, u):
+    """Sample a state from unnormalized log-probabilities `log_p`.
+
+    The array `p` is used to store the exponentiated values.
+    """
+    M = log_p.shape[0]
+
+    m = -np.inf
+    for i in range(M):
+        m = max(m, log_p[i])
+
+    for i in range(M):
+        p[i] = np.exp(log_p[i] - m)
+
+    return _sample_categorical(p, u)
+
+
+@njit(cache=True, fastmath=_fastmath_flags, error_model="numpy")  # pragma: no cover
+def _backward(log_alphas, Gammas, u, out):
+    """Sample a state sequence in-place given the forward probabilities.
+
+    Parameters
+    ----------
+    log_alphas
+        An array of shape ``(M, N)`` containing the log-scale forward
+        probabilities computed by `_forward`.
+    Gammas
+        An array of shape ``(N, M, M)`` or ``(1, M, M)`` containing the
+        transition probability matrices.
+    u
+        An array of ``N`` uniform samples used to sample the states.
+    out
+        An array of length ``N`` in which the sampled states are stored.
+
+    """
+    M, N = log_alphas.shape
+    time_varying = Gammas.shape[0] > 1
+
+    log_Gamma = np.empty((M, M))
+    _log_matrix(Gammas[0], log_Gamma)
+
+    log_beta_n = np.empty(M)
+    beta_n = np.empty(M)
+
+    for i in range(M):
+        log_beta_n[i] = log_alphas[i, N - 1]
+
+    state_np1 = _sample_log_categorical(log_beta_n, beta_n, u[N - 1])
+    out[N - 1] = state_np1
+
+    for n in range(N - 2, -1, -1):
+        if time_varying:
+            # `Gammas[n + 1]` holds the transition probabilities from `n` to
+            # `n + 1`
+            for i in range(M):
+                log_beta_n[i] = log_alphas[i, n] + np.log(Gammas[n + 1, i, state_np1])
+        else:
+            for i in range(M):
+                log_beta_n[i] = log_alphas[i, n] + log_Gamma[i, state_np1]
+
+        state_np1 = _sample_log_categorical(log_beta_n, beta_n, u[n])
+        out[n] = state_np1
+
+
+@njit(cache=True, fastmath=_fastmath_flags, error_model="numpy")  # pragma: no cover
+def _logaddexp(a, b):
+    """Compute ``log(exp(a) + exp(b))`` for scalars."""
+    m = max(a, b)
+
+    if m == -np.inf:
+        return -np.inf
+
+    return m + np.log1p(np.exp(min(a, b) - m))
+
+
+@njit(cache=True, fastmath=_fastmath_flags, error_model="numpy")  # pragma: no cover
+def _forward_k2(gamma_0, Gammas, log_lik, log_alphas):
+    """Compute the normalized log-scale forward probabilities of a two-state chain.
+
+    This is equivalent to `_forward`, but the state loops are unrolled, so the
+    forward probabilities and transition log-probabilities stay in scalar
+    variables.
+
+    Parameters
+    ----------
+    gamma_0
+        The initial state probabilities.
+    Gammas
+        An array of shape ``(N, 2, 2)`` or ``(1, 2, 2)`` containing the
+        transition probability matrices.
+    log_lik
+        An array of shape ``(2, N)`` containing the log-likelihood values for
+        each state at each point in the sequence.
+    log_alphas
+        An array of shape ``(2, N)`` in which the log-scale forward
+        probabilities are stored.
+
+    """
+    N = log_lik.shape[1]
+    time_varying = Gammas.shape[0] > 1
+
+    log_G_00 = np.log(Gammas[0, 0, 0])
+    log_G_01 = np.log(Gammas[0, 0, 1])
+    log_G_10 = np.log(Gammas[0, 1, 0])
+    log_G_11 = np.log(Gammas[0, 1, 1])
+
+    gamma_0_sum = gamma_0[0] + gamma_0[1]
+    log_alpha_0 = np.log(gamma_0[0] / gamma_0_sum)
+    log_alpha_1 = np.log(gamma_0[1] / gamma_0_sum)
+
+    for n in range(N):
+        if time_varying:
+            log_G_00 = np.log(Gammas[n, 0, 0])
+            log_G_01 = np.log(Gammas[n, 0, 1])
+            log_G_10 = np.log(Gammas[n, 1, 0])
+            log_G_11 = np.log(Gammas[n, 1, 1])
+
+        log_alpha_0_n = (
+            _logaddexp(log_alpha_0 + log_G_00, log_alpha_1 + log_G_10) + log_lik[0, n]
+        )
+        log_alpha_1_n = (
+            _logaddexp(log_alpha_0 + log_G_01, log_alpha_1 + log_G_11) + log_lik[1, n]
+        )
+        log_norm = _logaddexp(log_alpha_0_n, log_alpha_1_n)
+
+        log_alpha_0 = log_alpha_0_n - log_norm
+        log_alpha_1 = log_alpha_1_n - log_norm
+
+        log_alphas[0, n] = log_alpha_0
+        log_alphas[1, n] = log_alpha_1
+
+
+@njit(cache=True, fastmath=_fastmath_flags, error_model="numpy")  # pragma: no cover
+def _poisson_zero_loglik(y, mu, out):
+    """Compute the state log-likelihoods of a `PoissonZeroProcess` in-place.
+
+    Parameters
+    ----------
+    y
+        An array of ``N`` observations.
+    mu
+        An array of ``N`` Poisson rates.
+    out
+        An array of shape ``(2, N)`` in which the log-likelihoods of the
+        Dirac-delta (i.e. state ``0``) and Poisson (i.e. state ``1``)
+        components are stored.
+
+    """
+    for t in range(y.shape[0]):
+        y_t = y[t]
+        mu_t = mu[t]
+
+        out[0, t] = 0.0 if y_t == 0 else -np.inf
+
+        if y_t < 0 or mu_t < 0:
+            out[1, t] = -np.inf
+        elif y_t == 0:
+            out[1, t] = -mu_t
+        else:
+            out[1, t] = y_t * np.log(mu_t) - mu_t - math.lgamma(y_t + 1.0)
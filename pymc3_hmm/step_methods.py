@@ -1,4 +1,5 @@
 from itertools import chain
+from typing import Callable, Dict, List, Optional, Tuple
 
 import numpy as np
 import pymc3 as pm
@@ -7,8 +8,9 @@ import theano.tensor as tt
 from pymc3.distributions.distribution import draw_values
 from pymc3.step_methods.arraystep import ArrayStep, BlockedStep, Competence
 from pymc3.util import get_untransformed_name
+from scipy.special import logsumexp
 from theano.compile import optdb
-from theano.graph.basic import Variable, graph_inputs
+from theano.graph.basic import Constant, Variable, graph_inputs
 from theano.graph.fg import FunctionGraph
 from theano.graph.op import get_test_value as test_value
 from theano.graph.opt import OpRemove, pre_greedy_local_optimizer
@@ -17,11 +19,71 @@ from theano.tensor.elemwise import DimShuffle, Elemwise
 from theano.tensor.subtensor import AdvancedIncSubtensor1
 from theano.tensor.var import TensorConstant
 
-from pymc3_hmm.distributions import DiscreteMarkovChain, SwitchingProcess
-from pymc3_hmm.utils import compute_trans_freqs
+from pymc3_hmm._ffbs_numba import _backward, _forward, _forward_k2, _poisson_zero_loglik
+from pymc3_hmm.distributions import (
+    DiscreteMarkovChain,
+    PoissonZeroProcess,
+    SwitchingProcess,
+)
+from pymc3_hmm.utils import compute_trans_freqs, logdotexp
 
-big: float = 1e20
-small: float = 1.0 / big
+
+def _check_ffbs_shapes(
+    gamma_0: np.ndarray,
+    Gammas: np.ndarray,
+    log_lik: np.ndarray,
+    alphas: np.ndarray,
+    out: np.ndarray,
+):
+    """Make sure the shapes of the `ffbs_step` arguments are consistent.
+
+    The compiled kernels don't check their array bounds, so inconsistent
+    shapes need to be caught before they're called.
+    """
+    M, N = log_lik.shape
+
+    if N == 0:
+        raise ValueError("The state sequence must have a positive length")
+
+    if Gammas.ndim > 2 and Gammas.shape[-3] not in (1, N):
+        raise ValueError(
+            "The transition matrices must broadcast to a sequence of length"
+            " {}; got shape {}".format(N, Gammas.shape)
+        )
+
+    if not (gamma_0.shape[-1] == Gammas.shape[-1] == Gammas.shape[-2] == M):
+        raise ValueError(
+            "The initial state probabilities (shape {}), transition matrices"
+            " (shape {}) and log-likelihoods (shape {}) must have the same"
+            " number of states".format(gamma_0.shape, Gammas.shape, log_lik.shape)
+        )
+
+    if alphas.shape != log_lik.shape:
+        raise ValueError(
+            "The forward probabilities array must have shape {}; got shape"
+            " {}".format(log_lik.shape, alphas.shape)
+        )
+
+    if out.shape != (N,):
+        raise ValueError(
+            "The output array must have shape {}; got shape {}".format((N,), out.shape)
+        )
+
+
+def _use_compiled_ffbs(
+    gamma_0: np.ndarray, Gammas: np.ndarray, log_lik: np.ndarray, alphas: np.ndarray
+) -> bool:
+    """Determine whether or not the compiled FFBS kernels can be used."""
+    return (
+        Gammas.ndim == 3
+        and all(
+            x.dtype in (np.float32, np.float64) and x.flags.c_contiguous
+            for x in (log_lik, alphas)
+        )
+        and all(
+            x.dtype == np.float64 and x.flags.c_contiguous for x in (gamma_0, Gammas)
+        )
+    )
 
 
 def ffbs_step(
@@ -30,9 +92,16 @@ def ffbs_step(
     log_lik: np.ndarray,
     alphas: np.ndarray,
     out: np.ndarray,
+    backend: str = "numba",
 ):
     """Sample a forward-filtered backward-sampled (FFBS) state sequence.
 
+    When the arguments are C-contiguous ``float64`` arrays, the Numba-compiled
+    kernels in `pymc3_hmm._ffbs_numba` are used; otherwise, a (much slower)
+    NumPy implementation is used.  `log_lik` and `alphas` can also be
+    ``float32`` arrays, which halves the memory used to store them; the
+    recursions themselves are still computed in ``float64``.
+
     Parameters
     ----------
     gamma_0
@@ -47,67 +116,81 @@ def ffbs_step(
         An array of shape `(M, N)` consisting of the log-likelihood values for
         each state value at each point in the sequence.
     alphas
-        An array in which to store the forward probabilities.
+        An array of shape `(M, N)` in which to store the (normalized)
+        log-scale forward probabilities.
     out
         An output array to be updated in-place with the posterior sample
         states.
+    backend
+        Either ``"numba"`` (the default), which uses the implementations
+        described above, or ``"jax"``.  With ``"jax"``, the forward pass is
+        computed by a JIT-compiled `jax.lax.scan` (e.g. on a GPU) and the states
+        are sampled by the Numba-compiled backward pass.  This requires JAX.
 
     """
-    # Number of observations
-    N: int = log_lik.shape[-1]
+    _check_ffbs_shapes(gamma_0, Gammas, log_lik, alphas, out)
+
+    # The uniform samples used to sample the categorical states
+    unif_samples: np.ndarray = np.random.uniform(size=out.shape)
 
-    # Number of states
-    M: int = gamma_0.shape[-1]
-    # assert M == log_lik.shape[-2]
+    if backend == "jax":
+        # JAX is an optional dependency
+        from pymc3_hmm._ffbs_jax import _forward_jax
 
-    # Initial state probabilities
-    gamma_0_normed: np.ndarray = gamma_0.copy()
-    gamma_0_normed /= np.sum(gamma_0)
+        alphas[...] = _forward_jax(gamma_0, Gammas, log_lik)
 
-    # Previous forward probability
-    alpha_nm1: np.ndarray = gamma_0_normed
+        # The compiled backward pass requires a sequence of transition matrices
+        Gammas = np.broadcast_to(Gammas, (1,) * (3 - Gammas.ndim) + Gammas.shape)
+        _backward(alphas, np.asarray(Gammas, dtype=np.float64), unif_samples, out)
+        return out
+    elif backend != "numba":
+        raise ValueError("Unknown FFBS backend: {}".format(backend))
 
-    # Make sure we have a transition matrix for each element in a state
-    # sequence
-    Gamma: np.ndarray = np.broadcast_to(Gammas, (N,) + Gammas.shape[-2:])
+    if _use_compiled_ffbs(gamma_0, Gammas, log_lik, alphas):
+        if Gammas.shape[-1] == 2:
+            _forward_k2(gamma_0, Gammas, log_lik, alphas)
+        else:
+            _forward(gamma_0, Gammas, log_lik, alphas)
 
-    lik_n: np.ndarray = np.empty((M,), dtype=float)
-    alpha_n: np.ndarray = np.empty((M,), dtype=float)
+        _backward(alphas, Gammas, unif_samples, out)
+        return out
 
-    # Forward filtering
-    for n in range(N):
-        log_lik_n: np.ndarray = log_lik[..., n]
-        np.exp(log_lik_n - log_lik_n.max(), out=lik_n)
-        np.dot(alpha_nm1, Gamma[n], out=alpha_n)
-        alpha_n *= lik_n
-        alpha_n_sum: float = np.sum(alpha_n)
+    # Number of observations
+    N: int = log_lik.shape[-1]
 
-        # Rescale small values
-        if alpha_n_sum < small:
-            alpha_n *= big
+    with np.errstate(divide="ignore", under="ignore"):
+        # Make sure we have a transition matrix for each element in a state
+        # sequence
+        log_Gamma: np.ndarray = np.broadcast_to(
+            np.log(Gammas), (N,) + Gammas.shape[-2:]
+        )
 
-        alpha_nm1 = alpha_n
-        alphas[..., n] = alpha_n
+        # Initial state log-probabilities
+        log_alpha_nm1: np.ndarray = np.log(gamma_0) - np.log(np.sum(gamma_0))
 
-    # The uniform samples used to sample the categorical states
-    unif_samples: np.ndarray = np.random.uniform(size=out.shape)
+        # Forward filtering
+        for n in range(N):
+            log_alpha_n: np.ndarray = (
+                logdotexp(log_Gamma[n].T, log_alpha_nm1) + log_lik[..., n]
+            )
+            log_alpha_n -= logsumexp(log_alpha_n)
 
-    alpha_N: np.ndarray = alphas[..., N - 1]
-    beta_N: np.ndarray = alpha_N / alpha_N.sum()
+            log_alpha_nm1 = log_alpha_n
+            alphas[..., n] = log_alpha_n
 
-    state_np1: np.ndarray = np.searchsorted(beta_N.cumsum(), unif_samples[N - 1])
+        beta_N: np.ndarray = np.exp(alphas[..., N - 1])
 
-    out[N - 1] = state_np1
+        state_np1: np.ndarray = np.searchsorted(beta_N.cumsum(), unif_samples[N - 1])
 
-    beta_n: np.ndarray = np.empty((M,), dtype=float)
+        out[N - 1] = state_np1
 
-    # Backward sampling
-    for n in range(N - 2, -1, -1):
-        np.multiply(alphas[..., n], Gamma[n, :, state_np1], out=beta_n)
-        beta_n /= np.sum(beta_n)
+        # Backward sampling
+        for n in range(N - 2, -1, -1):
+            log_beta_n: np.ndarray = alphas[..., n] + log_Gamma[n + 1, :, state_np1]
+            beta_n: np.ndarray = np.exp(log_beta_n - logsumexp(log_beta_n))
 
-        state_np1 = np.searchsorted(beta_n.cumsum(), unif_samples[n])
-        out[n] = state_np1
+            state_np1 = np.searchsorted(beta_n.cumsum(), unif_samples[n])
+            out[n] = state_np1
 
     return out
 
@@ -129,7 +212,24 @@ class FFBSStep(BlockedStep):
 
     name = "ffbs"
 
-    def __init__(self, vars, values=None, model=None):
+    def __init__(
+        self, vars, values=None, model=None, dtype=np.float64, backend="numba"
+    ):
+        """Initialize a `FFBSStep` object.
+
+        Parameters
+        ----------
+        vars: list of TensorVariable
+            A list containing the single `DiscreteMarkovChain` to sample.
+        model: Model (optional)
+            The model containing `vars`.
+        dtype: dtype (optional)
+            The floating-point type used to store the state log-likelihoods and
+            forward probabilities.  Using ``np.float32`` halves the memory that
+            each step reads and writes.
+        backend: str (optional)
+            The backend used by `ffbs_step` to compute the forward pass.
+        """
 
         if len(vars) > 1:
             raise ValueError("This sampler only takes one variable.")
@@ -142,6 +242,8 @@ class FFBSStep(BlockedStep):
         model = pm.modelcontext(model)
 
         self.vars = [var]
+        self.dtype = np.dtype(dtype)
+        self.backend = backend
 
         self.dependent_rvs = [
             v
@@ -150,14 +252,52 @@ class FFBSStep(BlockedStep):
         ]
 
         dep_comps_logp_stacked = []
+        poisson_zero_mus = []
+        self.poisson_zero_obs: List[Tuple[Callable, np.ndarray, np.ndarray]] = []
         for i, dependent_rv in enumerate(self.dependent_rvs):
-            if isinstance(dependent_rv.distribution, SwitchingProcess):
+            dependent_dist = dependent_rv.distribution
+            obs = getattr(dependent_rv, "observations", None)
+
+            if (
+                isinstance(dependent_dist, PoissonZeroProcess)
+                and isinstance(obs, np.ndarray)
+                and not isinstance(obs, np.ma.MaskedArray)
+                and obs.ndim == 1
+                and dependent_dist.mu.ndim <= 1
+            ):
+                # The log-likelihoods of observed `PoissonZeroProcess`es are
+                # computed by a compiled kernel, so we only need their Poisson
+                # rates and a buffer (reused across steps) for the results
+                poisson_zero_mus.append(dependent_dist.mu)
+                self.poisson_zero_obs.append(
+                    (
+                        model.fn(dependent_dist.mu),
+                        obs,
+                        np.empty((2,) + obs.shape, dtype=self.dtype),
+                    )
+                )
+                continue
+
+            if isinstance(dependent_dist, SwitchingProcess):
                 comp_logps = []
 
                 # Get the log-likelihoood sequences for each state in this
                 # `SwitchingProcess` observations distribution
-                for comp_dist in dependent_rv.distribution.comp_dists:
-                    comp_logps.append(comp_dist.logp(dependent_rv))
+                for comp_dist in dependent_dist.comp_dists:
+                    comp_logp = comp_dist.logp(dependent_rv)
+
+                    # Log-likelihoods that only depend on constants (e.g. the
+                    # Dirac-delta component of a `PoissonZeroProcess` and
+                    # its observations) are computed once, here, instead of
+                    # at every step
+                    if all(
+                        isinstance(inp, Constant) for inp in graph_inputs([comp_logp])
+                    ):
+                        comp_logp = tt.as_tensor_variable(
+                            model.fn(comp_logp)(model.test_point)
+                        )
+
+                    comp_logps.append(comp_logp)
 
                 comp_logp_stacked = tt.stack(comp_logps)
             else:
@@ -167,24 +307,87 @@ class FFBSStep(BlockedStep):
 
             dep_comps_logp_stacked.append(comp_logp_stacked)
 
-        comp_logp_stacked = tt.sum(dep_comps_logp_stacked, axis=0)
-
         (M,) = draw_values([var.distribution.gamma_0.shape[-1]], point=model.test_point)
         N = model.test_point[var.name].shape[-1]
-        self.alphas = np.empty((M, N), dtype=float)
+        self.alphas = np.empty((M, N), dtype=self.dtype)
+
+        if dep_comps_logp_stacked:
+            comp_logp_stacked = tt.sum(dep_comps_logp_stacked, axis=0)
+            self.log_lik_states: Optional[Callable] = model.fn(comp_logp_stacked)
+        else:
+            self.log_lik_states = None
 
-        self.log_lik_states = model.fn(comp_logp_stacked)
         self.gamma_0_fn = model.fn(var.distribution.gamma_0)
         self.Gammas_fn = model.fn(var.distribution.Gammas)
 
+        # The log-likelihoods only need to be recomputed when the values of
+        # the model variables on which they depend change (e.g. the Poisson
+        # rate in a `PoissonZeroProcess`).  When they depend on anything else
+        # (e.g. shared variables), they're always recomputed.
+        log_lik_inputs = [
+            inp
+            for inp in graph_inputs(dep_comps_logp_stacked + poisson_zero_mus)
+            if not isinstance(inp, Constant)
+        ]
+        if all(inp in model.vars for inp in log_lik_inputs):
+            self.log_lik_input_names: Optional[List[str]] = [
+                inp.name for inp in log_lik_inputs
+            ]
+        else:
+            self.log_lik_input_names = None
+        self.log_lik_cache: Dict[Tuple[bytes, ...], np.ndarray] = {}
+
+    def _compute_log_lik_state_vals(self, point):
+        log_lik_state_vals = None
+
+        if self.log_lik_states is not None:
+            log_lik_state_vals = self.log_lik_states(point).astype(
+                self.dtype, copy=False
+            )
+
+        for mu_fn, obs, poisson_zero_log_lik in self.poisson_zero_obs:
+            mu = np.broadcast_to(mu_fn(point), obs.shape)
+            _poisson_zero_loglik(obs, mu, poisson_zero_log_lik)
+
+            if log_lik_state_vals is None:
+                log_lik_state_vals = poisson_zero_log_lik
+            else:
+                log_lik_state_vals += poisson_zero_log_lik
+
+        return log_lik_state_vals
+
+    def _log_lik_state_vals(self, point):
+        if self.log_lik_input_names is None:
+            return self._compute_log_lik_state_vals(point)
+
+        cache_key = tuple(
+            np.asarray(point[name]).tobytes() for name in self.log_lik_input_names
+        )
+        log_lik_state_vals = self.log_lik_cache.get(cache_key)
+
+        if log_lik_state_vals is None:
+            log_lik_state_vals = self._compute_log_lik_state_vals(point)
+            # Only the most recent values are kept
+            self.log_lik_cache.clear()
+            self.log_lik_cache[cache_key] = log_lik_state_vals
+
+        return log_lik_state_vals
+
     def step(self, point):
-        gamma_0 = self.gamma_0_fn(point)
-        # TODO: Can we update these in-place (e.g. using a shared variable)?
-        Gammas_t = self.Gammas_fn(point)
+        # The compiled FFBS kernels require C-contiguous `float64` transition
+        # probabilities (e.g. they're `float32` when `floatX` is), and these
+        # are only `M`-many `M x M` matrices, so converting them is cheap
+        gamma_0 = np.ascontiguousarray(self.gamma_0_fn(point), dtype=np.float64)
         # TODO: Can we update these in-place (e.g. using a shared variable)?
-        log_lik_state_vals = self.log_lik_states(point)
+        Gammas_t = np.ascontiguousarray(self.Gammas_fn(point), dtype=np.float64)
+        log_lik_state_vals = self._log_lik_state_vals(point)
         ffbs_step(
-            gamma_0, Gammas_t, log_lik_state_vals, self.alphas, point[self.vars[0].name]
+            gamma_0,
+            Gammas_t,
+            log_lik_state_vals,
+            self.alphas,
+            point[self.vars[0].name],
+            backend=self.backend,
         )
         return point
 
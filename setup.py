@@ -17,9 +17,11 @@ setup(
     install_requires=[
         "numpy>=1.18.1",
         "scipy>=1.4.0",
-        "pymc3==3.11.2",
-        "theano-pymc>=1.1.0",
+        "numba>=0.50.0",
+        "pymc3>=3.11.2,<3.12",
+        "theano-pymc>=1.1.0,<1.2",
     ],
+    extras_require={"jax": ["jax", "jaxlib"]},
     tests_require=["pytest"],
     long_description=open("README.md").read() if exists("README.md") else "",
     long_description_content_type="text/markdown",
@@ -0,0 +1,56 @@
+import hashlib
+import inspect
+
+import numpy as np
+import pymc3 as pm
+import pytest
+
+import pymc3_hmm.distributions
+from tests.utils import simulate_poiszero_hmm
+
+
+def _sim_cache_key(name, *args):
+    """Construct a pytest cache key for the results of a seeded simulation.
+
+    Along with the simulation arguments, `args`, the key includes a hash of
+    the simulation code and the package versions that determine its results,
+    so that the results of older simulations aren't reused.
+    """
+    sim_hash = hashlib.sha256()
+    for sim_input in (
+        inspect.getsource(simulate_poiszero_hmm),
+        inspect.getsource(pymc3_hmm.distributions),
+        pm.__version__,
+        np.__version__,
+    ):
+        sim_hash.update(sim_input.encode())
+
+    return "{}/{}_{}".format(
+        name, "_".join(str(a) for a in args), sim_hash.hexdigest()[:16]
+    )
+
+
+@pytest.fixture(scope="session")
+def poiszero_sim_9000_5000(request):
+    """Simulate a long Poisson-zero HMM with extremely large mixture separation.
+
+    The simulation is seeded, so its results are stored in the pytest cache
+    and reused across test sessions.
+    """
+    cache = getattr(request.config, "cache", None)
+    cache_key = _sim_cache_key("poiszero", 9000, 5000, 2032)
+
+    cached_sim = cache.get(cache_key, None) if cache is not None else None
+
+    if cached_sim is not None:
+        return {k: np.asarray(v) for k, v in cached_sim.items()}
+
+    np.random.seed(2032)
+    poiszero_sim, _ = simulate_poiszero_hmm(9000, 5000)
+
+    if cache is not None:
+        cache.set(
+            cache_key, {k: np.asarray(v).tolist() for k, v in poiszero_sim.items()}
+        )
+
+    return poiszero_sim
@@ -3,14 +3,22 @@ import warnings
 import numpy as np
 import pymc3 as pm
 import pytest
-import scipy as sp
+import theano
 import theano.tensor as tt
-from theano.graph.op import get_test_value
 
 from pymc3_hmm.distributions import DiscreteMarkovChain, PoissonZeroProcess
-from pymc3_hmm.step_methods import FFBSStep, TransMatConjugateStep, ffbs_step
+from pymc3_hmm.step_methods import (
+    FFBSStep,
+    TransMatConjugateStep,
+    _use_compiled_ffbs,
+    ffbs_step,
+)
 from pymc3_hmm.utils import compute_steady_state, compute_trans_freqs
-from tests.utils import simulate_poiszero_hmm
+from tests.utils import poisson_logpmf_fast, simulate_poiszero_hmm, untransform_value
+
+# A read-only identity transition matrix that's shared by the tests below
+_EYE2 = np.eye(2)
+_EYE2.flags.writeable = False
 
 
 @pytest.fixture()
@@ -19,9 +27,44 @@ def raise_under_overflow():
         yield
 
 
+@pytest.fixture(scope="module")
+def compile_ffbs():
+    # Compile (or load from the cache) the FFBS kernels, so that the first
+    # test to use them isn't dominated by compile time.  Each forward
+    # probabilities `dtype` has its own specialization.
+    for dtype in (np.float64, np.float32):
+        alphas = np.empty((2, 2), dtype=dtype)
+        res = np.empty(2)
+        ffbs_step(np.r_[0.5, 0.5], np.eye(2)[None, ...], np.zeros((2, 2)), alphas, res)
+
+
+@pytest.fixture()
+def poiszero_mu_model(request):
+    """Construct a two-state Poisson-zero HMM with a random Poisson rate.
+
+    The model is constructed--and the test is run--using the ``floatX`` given by
+    an (indirect) parameter, if any.
+    """
+    floatX = getattr(request, "param", theano.config.floatX)
+
+    np.random.seed(2032)
+
+    poiszero_sim, _ = simulate_poiszero_hmm(30, 150)
+    y_test = poiszero_sim["Y_t"]
+
+    with theano.config.change_flags(floatX=floatX):
+        with pm.Model() as test_model:
+            P_rv = np.array([[[0.9, 0.1], [0.1, 0.9]]])
+            S_rv = DiscreteMarkovChain("S_t", P_rv, np.r_[0.5, 0.5], shape=y_test.shape)
+            mu_rv = pm.Gamma("mu", 150.0, 1.0)
+            PoissonZeroProcess("Y_t", mu_rv, S_rv, observed=y_test)
+
+        yield test_model, y_test
+
+
 # All tests in this module will raise on over- and under-flows (unless local
 # settings dictate otherwise)
-pytestmark = pytest.mark.usefixtures("raise_under_overflow")
+pytestmark = pytest.mark.usefixtures("compile_ffbs", "raise_under_overflow")
 
 
 def test_ffbs_step():
@@ -36,7 +79,7 @@ def test_ffbs_step():
     test_log_lik_0 = np.stack(
         [np.broadcast_to(0.0, 10000), np.broadcast_to(-np.inf, 10000)]
     )
-    alphas = np.empty(test_log_lik_0.shape)
+    alphas = np.empty(test_log_lik_0.shape, dtype=np.float32)
     res = np.empty(test_log_lik_0.shape[-1])
     ffbs_step(test_gamma_0, test_Gammas, test_log_lik_0, alphas, res)
     assert np.all(res == 0)
@@ -44,7 +87,7 @@ def test_ffbs_step():
     test_log_lik_1 = np.stack(
         [np.broadcast_to(-np.inf, 10000), np.broadcast_to(0.0, 10000)]
     )
-    alphas = np.empty(test_log_lik_1.shape)
+    alphas = np.empty(test_log_lik_1.shape, dtype=np.float32)
     res = np.empty(test_log_lik_1.shape[-1])
     ffbs_step(test_gamma_0, test_Gammas, test_log_lik_1, alphas, res)
     assert np.all(res == 1)
@@ -56,14 +99,12 @@ def test_ffbs_step():
         np.random.poisson(10, 10000),
         np.random.poisson(50, 10000),
     )
-    test_log_lik_p = np.stack(
-        [sp.stats.poisson.logpmf(test_obs, 10), sp.stats.poisson.logpmf(test_obs, 50)],
-    )
+    test_log_lik_p = poisson_logpmf_fast(test_obs, np.c_[[10, 50]])
 
     # TODO FIXME: This is a statistically unsound/unstable check.
     assert np.mean(np.abs(test_log_lik_p.argmax(0) - test_seq)) < 1e-2
 
-    alphas = np.empty(test_log_lik_p.shape)
+    alphas = np.empty(test_log_lik_p.shape, dtype=np.float32)
     res = np.empty(test_log_lik_p.shape[-1])
     ffbs_step(test_gamma_0, test_Gammas, test_log_lik_p, alphas, res)
     # TODO FIXME: This is a statistically unsound/unstable check.
@@ -87,16 +128,110 @@ def test_ffbs_step():
     test_log_lik[::2] = test_log_lik[::2][:, ::-1]
     test_log_lik = test_log_lik.T
 
-    alphas = np.empty(test_log_lik.shape)
+    alphas = np.empty(test_log_lik.shape, dtype=np.float32)
     res = np.empty(test_log_lik.shape[-1])
     ffbs_step(test_gamma_0, test_Gammas, test_log_lik, alphas, res)
     assert np.array_equal(res, np.r_[1, 0, 0, 1])
 
+    with pytest.raises(ValueError):
+        ffbs_step(test_gamma_0, test_Gammas, test_log_lik, alphas, res, "blah")
+
+    # Inconsistent shapes are rejected before the compiled kernels are used
+    test_Gammas_bad = np.broadcast_to(_EYE2, (3, 2, 2)).copy()
+    with pytest.raises(ValueError):
+        ffbs_step(test_gamma_0, test_Gammas_bad, test_log_lik, alphas, res)
+
+    with pytest.raises(ValueError):
+        ffbs_step(np.r_[1.0, 0.0, 0.0], test_Gammas, test_log_lik, alphas, res)
+
+    with pytest.raises(ValueError):
+        ffbs_step(test_gamma_0, test_Gammas, test_log_lik, alphas[:, :-1], res)
+
+    with pytest.raises(ValueError):
+        ffbs_step(test_gamma_0, test_Gammas, test_log_lik, alphas, res[:-1])
+
+    # An empty state sequence
+    with pytest.raises(ValueError):
+        ffbs_step(
+            test_gamma_0,
+            test_Gammas[:1],
+            test_log_lik[:, :0],
+            alphas[:, :0],
+            res[:0],
+        )
+
+
+@pytest.mark.parametrize(
+    "backend, alphas_atol, max_state_mismatch",
+    [
+        ("numpy", 1e-8, 0.0),
+        # JAX computes in single-precision by default, so a few sampled states
+        # could differ
+        ("jax", 1e-4, 1e-2),
+    ],
+)
+@pytest.mark.parametrize(
+    "test_Gammas, mus",
+    [
+        (np.array([[[0.9, 0.1], [0.1, 0.9]]]), [10, 50]),
+        (
+            np.array([[[0.8, 0.1, 0.1], [0.1, 0.8, 0.1], [0.1, 0.1, 0.8]]]),
+            [10, 50, 100],
+        ),
+    ],
+)
+def test_ffbs_step_backends(backend, alphas_atol, max_state_mismatch, test_Gammas, mus):
+    """Make sure the NumPy and JAX implementations agree with the compiled ones."""
+
+    if backend == "jax":
+        pytest.importorskip("jax")
+        test_Gammas_b = test_Gammas
+        ffbs_backend = "jax"
+    else:
+        # A non-contiguous transition matrix array isn't handled by the
+        # compiled implementation
+        test_Gammas_b = np.asfortranarray(test_Gammas)
+        assert not test_Gammas_b.flags.c_contiguous
+        ffbs_backend = "numba"
+
+    np.random.seed(2032)
+
+    M = len(mus)
+    test_gamma_0 = np.full(M, 1.0 / M)
+
+    test_seq = np.random.choice(M, size=1000)
+    test_obs = np.random.poisson(np.take(mus, test_seq))
+    test_log_lik = poisson_logpmf_fast(test_obs, np.c_[mus])
+
+    alphas = np.empty(test_log_lik.shape)
+    res = np.empty(test_log_lik.shape[-1])
+    np.random.seed(2032)
+    ffbs_step(test_gamma_0, test_Gammas, test_log_lik, alphas, res)
+
+    alphas_b = np.empty(test_log_lik.shape)
+    res_b = np.empty(test_log_lik.shape[-1])
+    np.random.seed(2032)
+    ffbs_step(test_gamma_0, test_Gammas_b, test_log_lik, alphas_b, res_b, ffbs_backend)
+
+    assert np.allclose(alphas, alphas_b, atol=alphas_atol)
+    assert np.mean(res != res_b) <= max_state_mismatch
+
+    # A single (2-D) transition matrix broadcasts across the state sequence
+    alphas_2d = np.empty(test_log_lik.shape)
+    res_2d = np.empty(test_log_lik.shape[-1])
+    np.random.seed(2032)
+    ffbs_step(
+        test_gamma_0, test_Gammas_b[0], test_log_lik, alphas_2d, res_2d, ffbs_backend
+    )
+
+    assert np.allclose(alphas_b, alphas_2d)
+    assert np.array_equal(res_b, res_2d)
+
 
 def test_FFBSStep():
 
     with pm.Model(), pytest.raises(ValueError):
-        P_rv = np.eye(2)[None, ...]
+        P_rv = np.broadcast_to(_EYE2, (1, 2, 2))
         S_rv = DiscreteMarkovChain("S_t", P_rv, np.r_[1.0, 0.0], shape=10)
         S_2_rv = DiscreteMarkovChain("S_2_t", P_rv, np.r_[0.0, 1.0], shape=10)
         PoissonZeroProcess(
@@ -112,7 +247,7 @@ def test_FFBSStep():
         ffbs = FFBSStep([S_rv])
 
     with pm.Model(), pytest.raises(TypeError):
-        P_rv = np.eye(2)[None, ...]
+        P_rv = np.broadcast_to(_EYE2, (1, 2, 2))
         S_rv = DiscreteMarkovChain("S_t", P_rv, np.r_[1.0, 0.0], shape=10)
         pm.Poisson("Y_t", S_rv, observed=np.random.poisson(9.0, size=10))
         # Only `SwitchingProcess`es can used as dependent variables
@@ -147,14 +282,131 @@ def test_FFBSStep():
 
     assert np.array_equal(res["S_t"], poiszero_sim["S_t"])
 
+    # The log-likelihoods and forward probabilities can be stored in
+    # single-precision
+    with test_model:
+        ffbs = FFBSStep([S_rv], dtype=np.float32)
+
+    assert ffbs.alphas.dtype == np.float32
 
-def test_FFBSStep_extreme():
+    res = ffbs.step(test_point)
+
+    assert ffbs._log_lik_state_vals(test_point).dtype == np.float32
+    assert np.array_equal(res["S_t"], poiszero_sim["S_t"])
+
+
+def test_FFBSStep_log_lik_cache(poiszero_mu_model):
+
+    test_model, y_test = poiszero_mu_model
+    mu_rv = test_model["mu"]
+
+    with test_model:
+        ffbs = FFBSStep([test_model["S_t"]])
+
+    # The Dirac-delta component's log-likelihood is constant, so only the
+    # Poisson rate determines the log-likelihoods
+    assert ffbs.log_lik_input_names == [mu_rv.transformed.name]
+
+    test_point = test_model.test_point.copy()
+    ffbs.step(test_point)
+    log_lik_vals = ffbs._log_lik_state_vals(test_point)
+    assert len(ffbs.log_lik_cache) == 1
+    assert np.array_equal(log_lik_vals[0], np.where(y_test == 0, 0.0, -np.inf))
+
+    # A cached value is reused
+    assert ffbs._log_lik_state_vals(test_point.copy()) is log_lik_vals
+
+    # A new rate value replaces the cached log-likelihoods (in the same
+    # buffer)
+    log_lik_vals_old = log_lik_vals.copy()
+    test_point[mu_rv.transformed.name] = np.log(100.0)
+    log_lik_vals = ffbs._log_lik_state_vals(test_point)
+    assert not np.array_equal(log_lik_vals[1], log_lik_vals_old[1])
+    assert np.array_equal(log_lik_vals[0], log_lik_vals_old[0])
+    assert len(ffbs.log_lik_cache) == 1
+
+    # Log-likelihoods that depend on shared variables aren't cached
+    with pm.Model() as test_model:
+        P_rv = np.array([[[0.9, 0.1], [0.1, 0.9]]])
+        y_data = pm.Data("y_data", y_test)
+        S_rv = DiscreteMarkovChain("S_t", P_rv, np.r_[0.5, 0.5], shape=y_test.shape)
+        PoissonZeroProcess("Y_t", 150.0, S_rv, observed=y_data)
+
+        ffbs = FFBSStep([S_rv])
+
+    assert ffbs.log_lik_input_names is None
+
+    ffbs.step(test_model.test_point.copy())
+    assert not ffbs.log_lik_cache
+
+
+def test_FFBSStep_poisson_zero_log_lik(poiszero_mu_model):
+
+    # The log-likelihoods of the model's observed `Y_t` are computed by the
+    # compiled kernel
+    test_model, y_test = poiszero_mu_model
+    S_rv = test_model["S_t"]
+    mu_rv = test_model["mu"]
+
+    with test_model:
+        # These log-likelihoods are computed by Theano
+        y_data = pm.Data("y_data", y_test)
+        PoissonZeroProcess("Y_2_t", mu_rv, S_rv, observed=y_data)
+
+        ffbs = FFBSStep([S_rv])
+
+    assert len(ffbs.poisson_zero_obs) == 1
+    assert ffbs.log_lik_states is not None
+
+    test_point = test_model.test_point.copy()
+    log_lik_vals = ffbs._log_lik_state_vals(test_point)
+
+    mu = np.exp(test_point[mu_rv.transformed.name])
+    exp_log_lik = 2 * np.stack(
+        [np.where(y_test == 0, 0.0, -np.inf), poisson_logpmf_fast(y_test, mu)]
+    )
+    assert np.allclose(log_lik_vals, exp_log_lik)
+
+
+@pytest.mark.parametrize("poiszero_mu_model", ["float32"], indirect=True)
+def test_FFBSStep_floatX_float32(poiszero_mu_model, monkeypatch):
+
+    test_model, y_test = poiszero_mu_model
+    S_rv = test_model["S_t"]
+
+    with test_model:
+        ffbs = FFBSStep([S_rv], dtype=np.float32)
+
+    test_point = test_model.test_point.copy()
+    assert ffbs.Gammas_fn(test_point).dtype == np.float32
+
+    use_compiled = []
+
+    def _use_compiled_ffbs_spy(*args):
+        use_compiled.append(_use_compiled_ffbs(*args))
+        return use_compiled[-1]
+
+    monkeypatch.setattr(
+        "pymc3_hmm.step_methods._use_compiled_ffbs", _use_compiled_ffbs_spy
+    )
+
+    res = ffbs.step(test_point)
+
+    # The single-precision transition probabilities don't cause a fallback
+    # to the NumPy implementation
+    assert use_compiled == [True]
+
+    # With such a large Poisson rate, only the Dirac-delta component produces
+    # zeros
+    assert np.array_equal(res[S_rv.name], y_test > 0)
+
+
+def test_FFBSStep_extreme(poiszero_sim_9000_5000):
     """Test a long series with extremely large mixture separation (and, thus, very small likelihoods)."""  # noqa: E501
 
     np.random.seed(2032)
 
-    mu_true = 5000
-    poiszero_sim, _ = simulate_poiszero_hmm(9000, mu_true)
+    poiszero_sim = poiszero_sim_9000_5000
     y_test = poiszero_sim["Y_t"]
 
     with pm.Model() as test_model:
@@ -182,8 +434,7 @@ def test_FFBSStep_extreme():
     test_point["p_0_stickbreaking__"] = poiszero_sim["p_0_stickbreaking__"]
     test_point["p_1_stickbreaking__"] = poiszero_sim["p_1_stickbreaking__"]
 
-    with np.errstate(over="ignore", under="ignore"):
-        res = ffbs.step(test_point)
+    res = ffbs.step(test_point)
 
     assert np.array_equal(res["S_t"], poiszero_sim["S_t"])
 
@@ -242,12 +493,8 @@ def test_TransMatConjugateStep():
 
     res = transmat.step(test_point)
 
-    p_0_smpl = get_test_value(
-        p_0_rv.distribution.transform.backward(res[p_0_rv.transformed.name])
-    )
-    p_1_smpl = get_test_value(
-        p_1_rv.distribution.transform.backward(res[p_1_rv.transformed.name])
-    )
+    p_0_smpl = untransform_value(p_0_rv, res[p_0_rv.transformed.name])
+    p_1_smpl = untransform_value(p_1_rv, res[p_1_rv.transformed.name])
 
     sampled_trans_mat = np.stack([p_0_smpl, p_1_smpl])
 
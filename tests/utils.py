@@ -1,6 +1,10 @@
+from functools import lru_cache
+
 import numpy as np
 import pymc3 as pm
+import theano
 import theano.tensor as tt
+from scipy.special import gammaln
 
 from pymc3_hmm.distributions import DiscreteMarkovChain, PoissonZeroProcess
 
@@ -31,3 +35,37 @@ def simulate_poiszero_hmm(
         sample_point["Y_t"] = sample_point["Y_t"].squeeze(0)
 
     return sample_point, test_model
+
+
+def poisson_logpmf_fast(k, mu):
+    """Compute Poisson log-probabilities for non-negative integer values.
+
+    The `gammaln` values are computed once for ``0, ..., max(k) + 1`` and
+    looked up, so `mu` can be an array of rates (e.g. with shape ``(M, 1)``)
+    that broadcasts against `k` without repeating that work.
+    """
+    k = np.asarray(k, dtype=int)
+    gammaln_tbl = gammaln(np.arange(k.max() + 2))
+    return k * np.log(mu) - mu - gammaln_tbl[k + 1]
+
+
+@lru_cache(maxsize=None)
+def _compiled_transform(ndim, dtype_str, transform):
+    """Compile the backward (i.e. untransform) function for a transform."""
+    x = tt.TensorType(dtype_str, (False,) * ndim)()
+    with theano.config.change_flags(compute_test_value="off"):
+        return theano.function([x], transform.backward(x))
+
+
+def untransform_value(rv, value):
+    """Map a value in the transformed space of `rv` back to its support.
+
+    The compiled functions are cached, so repeated calls for variables with
+    the same transform (e.g. Dirichlet rows of a transition matrix) only
+    compile once per session.
+    """
+    value = np.asarray(value)
+    transform_fn = _compiled_transform(
+        value.ndim, str(value.dtype), rv.distribution.transform
+    )
+    return transform_fn(value)